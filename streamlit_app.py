@@ -5,12 +5,23 @@ import tempfile
 import os
 from dotenv import load_dotenv
 import trimesh
+import numpy as np
 import plotly.graph_objects as go
 import re
+import base64
+import hashlib
+import shutil
+import time
+from collections.abc import Iterator
 
 # Load environment variables from .env
 load_dotenv(override=True)
 title = "3D Designer Agent"
+# Set OPENSCAD_NATIVE_3MF=1 to export 3MF with OpenSCAD itself instead of converting the STL
+NATIVE_3MF = os.getenv("OPENSCAD_NATIVE_3MF") == "1"
+# Per-session output directories; ones left untouched for WORK_DIR_TTL seconds are swept
+WORK_DIR_PREFIX = "chat2stl-"
+WORK_DIR_TTL = 6 * 60 * 60
 
 # Set the Streamlit layout to wide
 st.set_page_config(page_title=title, layout="wide")
@@ -20,13 +31,27 @@ SYSTEM_PROMPT = (
     "generate a parametric OpenSCAD script that fulfills the description. "
     "Only return the raw .scad code without any explanations or markdown formatting."
 )
+# Minimum number of recent user/assistant exchanges sent to the model as context
+HISTORY_TURNS = 4
 
+# Matches numeric assignments such as `width = 12.5;`
+_PARAM_RE = re.compile(r"(\w+)\s*=\s*([0-9.]+)\s*;")
+# Same assignment anchored at the start of a line, for scanning a whole file at once
+_PARAM_LINE_RE = re.compile(r"^" + _PARAM_RE.pattern, re.MULTILINE)
 
-# Cache SCAD generation to avoid repeated API calls for same prompt+history
-@st.cache_data
-def generate_scad(prompt: str, history: tuple[tuple[str, str]], api_key: str) -> str:
+
+def _history_window(history: tuple[tuple[str, str], ...], size: int) -> tuple[tuple[str, str], ...]:
+    """
+    Keep at least the last `size` messages, dropping older ones a whole block at a time so the
+    prompt prefix stays identical between jumps and the provider's prompt cache keeps hitting.
+    """
+    start = max(0, (len(history) // size - 1) * size)
+    return history[start:]
+
+
+def stream_scad(prompt: str, history: tuple[tuple[str, str]], api_key: str) -> Iterator[str]:
     """
-    Uses OpenAI API to generate OpenSCAD code from a user prompt.
+    Uses OpenAI API to generate OpenSCAD code from a user prompt, yielding text chunks as they arrive.
     """
     client = OpenAI(api_key=api_key)
     # Build conversation messages including history
@@ -34,37 +59,95 @@ def generate_scad(prompt: str, history: tuple[tuple[str, str]], api_key: str) ->
     for role, content in history:
         messages.append({"role": role, "content": content})
     messages.append({"role": "user", "content": prompt})
-    response = client.chat.completions.create(
+    stream = client.chat.completions.create(
         model="o4-mini",
         messages=messages,
         max_completion_tokens=4500,
+        stream=True,
     )
-    code = response.choices[0].message.content.strip()
-    return code
+    for event in stream:
+        if event.choices and event.choices[0].delta.content:
+            yield event.choices[0].delta.content
+
+
+def _remove_stale_work_dirs(parent: str):
+    cutoff = time.time() - WORK_DIR_TTL
+    for entry in os.scandir(parent):
+        try:
+            stale = entry.name.startswith(WORK_DIR_PREFIX) and entry.is_dir() and entry.stat().st_mtime < cutoff
+        except FileNotFoundError:
+            # Another session removed it between the listing and the stat
+            continue
+        if stale:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def session_work_dir() -> str:
+    """
+    Return this session's output directory, creating it on first use.
+    Prefers /dev/shm (tmpfs) when it has room, so OpenSCAD output never touches disk.
+    """
+    work_dir = st.session_state.get("work_dir")
+    if work_dir is not None:
+        try:
+            # Touch the directory so other sessions' stale sweep sees it as in use
+            os.utime(work_dir)
+            return work_dir
+        except FileNotFoundError:
+            pass
+    parents = [tempfile.gettempdir()]
+    if os.path.isdir("/dev/shm"):
+        parents.append("/dev/shm")
+    # Sweep every location a session may have used, not just the one picked now
+    for candidate in parents:
+        _remove_stale_work_dirs(candidate)
+    parent = parents[0]
+    if len(parents) > 1 and shutil.disk_usage("/dev/shm").free > 512 * 1024 * 1024:
+        parent = "/dev/shm"
+    work_dir = st.session_state.work_dir = tempfile.mkdtemp(prefix=WORK_DIR_PREFIX, dir=parent)
+    return work_dir
 
 
-@st.cache_data
-def generate_3d_files(scad_path: str, formats: list[str] = ["stl", "3mf"]) -> dict[str, str]:
+# Keyed on the SCAD source, so identical code reuses earlier outputs across turns.
+# The ttl matches the work directory sweep so entries never outlive the files they point to.
+@st.cache_data(max_entries=256, ttl=WORK_DIR_TTL)
+def generate_3d_files(scad_code: str, work_dir: str, formats: tuple[str, ...]) -> dict[str, str]:
     """
-    Generate 3D files from a SCAD file using OpenSCAD CLI for specified formats.
+    Generate 3D files from SCAD code using OpenSCAD CLI for specified formats.
+    Files are written to work_dir, named after a hash of the code, so the same source maps to the same paths.
     Returns a mapping from format extension to output file path.
-    Throws CalledProcessError on failure.
+    Throws CalledProcessError on failure; its stderr holds OpenSCAD's raw (undecoded) output.
     """
-    paths: dict[str, str] = {}
-    for fmt in formats:
-        output_path = scad_path.replace(".scad", f".{fmt}")
-        subprocess.run(["openscad", "-o", output_path, scad_path], check=True, capture_output=True, text=True)
-        paths[fmt] = output_path
+    digest = hashlib.blake2b(scad_code.encode("utf-8"), digest_size=16).hexdigest()
+    base_path = os.path.join(work_dir, digest)
+    scad_path = f"{base_path}.scad"
+    if not os.path.exists(scad_path):
+        with open(scad_path, "w") as f:
+            f.write(scad_code)
+    paths = {fmt: f"{base_path}.{fmt}" for fmt in formats}
+    # Unless native export is requested, 3MF is converted from the STL so the CSG is only rendered once
+    convert_3mf = "3mf" in paths and not NATIVE_3MF
+    stl_path = f"{base_path}.stl"
+    openscad_outputs = [path for fmt, path in paths.items() if not (convert_3mf and fmt == "3mf")]
+    if convert_3mf and stl_path not in openscad_outputs:
+        openscad_outputs.append(stl_path)
+    # Outputs are content-addressed, so an existing file (e.g. the STL a later 3MF request converts) is reused
+    openscad_outputs = [path for path in openscad_outputs if not os.path.exists(path)]
+    for output_path in openscad_outputs:
+        subprocess.run(
+            ["openscad", "-o", output_path, scad_path],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        )
+    if convert_3mf:
+        # Keep trimesh's processing here: it welds the STL's per-triangle vertices so slicers see a closed mesh
+        trimesh.load_mesh(stl_path, file_type="stl").export(paths["3mf"])
     return paths
 
 
+# Cache parameter parsing so history replay doesn't rescan unchanged code every rerun
+@st.cache_data(max_entries=128)
 def parse_scad_parameters(code: str) -> dict[str, float]:
-    params: dict[str, float] = {}
-    for line in code.splitlines():
-        m = re.match(r"(\w+)\s*=\s*([0-9\.]+)\s*;", line)
-        if m:
-            params[m.group(1)] = float(m.group(2))
-    return params
+    return {m.group(1): float(m.group(2)) for m in _PARAM_LINE_RE.finditer(code)}
 
 
 def apply_scad_parameters(code: str, params: dict[str, float]) -> str:
@@ -73,12 +156,62 @@ def apply_scad_parameters(code: str, params: dict[str, float]) -> str:
         if name in params:
             return f"{name} = {params[name]};"
         return match.group(0)
-    return re.sub(r"(\w+)\s*=\s*[0-9\.]+\s*;", repl, code)
+    return _PARAM_RE.sub(repl, code)
+
+
+def _preview_mesh(mesh: trimesh.Trimesh, max_faces: int = 20000) -> trimesh.Trimesh:
+    """
+    Decimate a mesh above max_faces for display; downloads still use the full-resolution file.
+    """
+    if len(mesh.faces) > max_faces:
+        return mesh.simplify_quadric_decimation(face_count=max_faces)
+    return mesh
+
+
+# Cache parsed mesh columns across reruns; mtime in the key invalidates on regeneration
+# Only read while building the (separately cached) figure spec, so a small bound suffices
+@st.cache_resource(max_entries=16, ttl=3600)
+def _load_mesh_arrays(path: str, mtime: float) -> tuple[np.ndarray, ...]:
+    """
+    Load an STL and return contiguous (x, y, z, i, j, k) columns for Mesh3d.
+    """
+    # Explicit file type skips format sniffing. Default processing is kept: it welds the STL's three
+    # private vertices per triangle into a shared, indexed vertex buffer for Mesh3d and the decimator
+    mesh = _preview_mesh(trimesh.load_mesh(path, file_type="stl"))
+    vertices, faces = mesh.vertices.view(np.ndarray), mesh.faces.view(np.ndarray)
+    # One transposing copy per array yields all three contiguous columns at once
+    vx, vy, vz = np.ascontiguousarray(vertices.T, dtype=np.float32)
+    # Use the narrowest index type Plotly's typed arrays accept (float16 vertices are not supported)
+    index_dtype = np.uint16 if len(vertices) <= np.iinfo(np.uint16).max + 1 else np.uint32
+    fi, fj, fk = np.ascontiguousarray(faces.T, dtype=index_dtype)
+    return vx, vy, vz, fi, fj, fk
+
+
+def _typed_array(arr: np.ndarray) -> dict[str, str]:
+    """
+    Encode a numpy array as a Plotly typed-array spec so the browser decodes it without JSON number parsing.
+    """
+    return {"dtype": arr.dtype.str.lstrip("<|"), "bdata": base64.b64encode(arr.tobytes()).decode("ascii")}
+
+
+# Cache the validated Figure itself: st.plotly_chart re-validates dict specs on every call,
+# but only serializes a Figure. The object is shared across sessions and must not be mutated.
+@st.cache_resource(max_entries=128, ttl=3600)
+def _mesh_figure(stl_path: str, mtime: float) -> go.Figure:
+    vx, vy, vz, fi, fj, fk = _load_mesh_arrays(stl_path, mtime)
+    trace = {
+        "type": "mesh3d",
+        "x": _typed_array(vx), "y": _typed_array(vy), "z": _typed_array(vz),
+        "i": _typed_array(fi), "j": _typed_array(fj), "k": _typed_array(fk),
+        "color": "lightblue", "opacity": 0.50,
+    }
+    layout = {"scene": {"aspectmode": "data"}, "margin": {"l": 0, "r": 0, "b": 0, "t": 0}}
+    return go.Figure(data=[trace], layout=layout)
 
 
 # Dialog for downloading model in chosen format
 @st.dialog("Download Model")
-def download_model_dialog(stl_path: str, threemf_path: str):
+def download_model_dialog(scad_code: str, stl_path: str):
     choice = st.radio("Choose file format", ["STL", "3MF"] )
     if choice == "STL":
         with open(stl_path, "rb") as f:
@@ -87,15 +220,69 @@ def download_model_dialog(stl_path: str, threemf_path: str):
                 mime="application/sla", on_click="ignore"
             )
     else:
-        with open(threemf_path, "rb") as f:
-            st.download_button(
-                label="Download 3MF File", data=f, file_name="model.3mf",
-                mime="application/octet-stream", on_click="ignore"
-            )
+        # 3MF is only generated when asked for, keeping it off the per-turn critical path
+        try:
+            with st.spinner("Preparing 3MF file..."):
+                threemf_path = generate_3d_files(scad_code, session_work_dir(), formats=("3mf",))["3mf"]
+        except subprocess.CalledProcessError as e:
+            st.error(f"OpenSCAD failed with exit code {e.returncode}")
+        else:
+            with open(threemf_path, "rb") as f:
+                st.download_button(
+                    label="Download 3MF File", data=f, file_name="model.3mf",
+                    mime="application/octet-stream", on_click="ignore"
+                )
     if st.button("Close"):
         st.rerun()
 
 
+def render_assistant_message(idx: int, msg: dict):
+    """
+    Render an assistant history entry: generated code, 3D preview, download and parameter controls.
+    """
+    with st.expander("Generated OpenSCAD Code", expanded=False):
+        st.code(msg["scad_code"], language="c")
+    if not os.path.exists(msg["stl_path"]):
+        # The work directory was swept or recreated; rebuild the STL from the stored code
+        try:
+            msg["stl_path"] = generate_3d_files(msg["scad_code"], session_work_dir(), formats=("stl",))["stl"]
+        except subprocess.CalledProcessError as e:
+            st.error(f"OpenSCAD failed with exit code {e.returncode}")
+            return
+    fig = _mesh_figure(msg["stl_path"], os.path.getmtime(msg["stl_path"]))
+    st.plotly_chart(fig, use_container_width=True, height=600, key=f"preview-{idx}")
+    # Single button to open download dialog
+    if st.button("Download Model", key=f"download-model-{idx}"):
+        download_model_dialog(msg["scad_code"], msg["stl_path"])
+    # Add parameter adjustment UI tied to this history message
+    params = parse_scad_parameters(msg["scad_code"])
+    with st.expander("Adjust parameters", expanded=False):
+        if not params:
+            st.write("No numeric parameters detected in the SCAD code.")
+        else:
+            # Use a form so inputs don't trigger reruns until submitted
+            with st.form(key=f"param-form-{idx}"):
+                updated: dict[str, float] = {}
+                for name, default in params.items():
+                    updated[name] = st.number_input(name, value=default, key=f"{idx}-{name}")
+                regenerate = st.form_submit_button("Regenerate Preview")
+            if regenerate:
+                # Apply new parameter values
+                new_code = apply_scad_parameters(msg["scad_code"], updated)
+                # Regenerate only STL preview for speed
+                try:
+                    stl_only_path = generate_3d_files(new_code, session_work_dir(), formats=("stl",))["stl"]
+                except subprocess.CalledProcessError as e:
+                    st.error(f"OpenSCAD failed with exit code {e.returncode}")
+                    return
+                # Update history message in place
+                msg["scad_code"] = new_code
+                msg["content"] = new_code
+                msg["stl_path"] = stl_only_path
+                # Rerun to refresh UI
+                st.rerun()
+
+
 def main():
     # Sidebar for custom OpenAI API key
     api_key = st.sidebar.text_input("OpenAI API Key", type="password", value=os.getenv("OPENAI_API_KEY", ""))
@@ -113,56 +300,16 @@ def main():
     if "history" not in st.session_state:
         st.session_state.history = []
 
+    # Keep this session's work directory marked as in use on every rerun
+    session_work_dir()
+
     # Replay full conversation history
     for idx, msg in enumerate(st.session_state.history):
         with st.chat_message(msg["role"]):
             if msg["role"] == "user":
                 st.write(msg["content"])
             else:
-                with st.expander("Generated OpenSCAD Code", expanded=False):
-                    st.code(msg["scad_code"], language="c")
-                mesh = trimesh.load(msg["stl_path"])
-                fig = go.Figure(data=[go.Mesh3d(
-                    x=mesh.vertices[:,0], y=mesh.vertices[:,1], z=mesh.vertices[:,2],
-                    i=mesh.faces[:,0], j=mesh.faces[:,1], k=mesh.faces[:,2],
-                    color='lightblue', opacity=0.50
-                )])
-                fig.update_layout(scene=dict(aspectmode='data'), margin=dict(l=0, r=0, b=0, t=0))
-                st.plotly_chart(fig, use_container_width=True, height=600)
-                # Single button to open download dialog
-                if st.button("Download Model", key=f"download-model-{idx}"):
-                    download_model_dialog(msg["stl_path"], msg["3mf_path"])
-                # Add parameter adjustment UI tied to this history message
-                if msg["role"] == "assistant":
-                    params = parse_scad_parameters(msg["scad_code"])
-                    with st.expander("Adjust parameters", expanded=False):
-                        if not params:
-                            st.write("No numeric parameters detected in the SCAD code.")
-                        else:
-                            # Use a form so inputs don't trigger reruns until submitted
-                            with st.form(key=f"param-form-{idx}"):
-                                updated: dict[str, float] = {}
-                                for name, default in params.items():
-                                    updated[name] = st.number_input(name, value=default, key=f"{idx}-{name}")
-                                regenerate = st.form_submit_button("Regenerate Preview")
-                            if regenerate:
-                                # Apply new parameter values
-                                new_code = apply_scad_parameters(msg["scad_code"], updated)
-                                # Overwrite SCAD file
-                                with open(msg["scad_path"], "w") as f:
-                                    f.write(new_code)
-                                # Regenerate only STL preview for speed
-                                try:
-                                    stl_only_path = generate_3d_files(msg["scad_path"], formats=["stl"])["stl"]
-                                except subprocess.CalledProcessError as e:
-                                    st.error(f"OpenSCAD failed with exit code {e.returncode}")
-                                    return
-                                # Update history message in place
-                                msg["scad_code"] = new_code
-                                msg["content"] = new_code
-                                msg["stl_path"] = stl_only_path
-                                # Rerun to refresh UI
-                                st.rerun()
+                render_assistant_message(idx, msg)
 
     # Accept new user input and handle conversation state
     if user_input := st.chat_input("Describe the desired object"):
@@ -172,37 +319,41 @@ def main():
 
         # Add user message to history
         st.session_state.history.append({"role": "user", "content": user_input})
-        # Generate SCAD and 3D files
-        with st.spinner("Generating and rendering your model..."):
-            history_for_api = tuple(
-                (m["role"], m["content"])
-                for m in st.session_state.history
-                if "content" in m and "role" in m
-            )
-            scad_code = generate_scad(user_input, history_for_api, api_key)
-            with tempfile.NamedTemporaryFile(suffix=".scad", delete=False) as scad_file:
-                scad_file.write(scad_code.encode("utf-8"))
-                scad_path = scad_file.name
-            try:
-                file_paths = generate_3d_files(scad_path)
-            except subprocess.CalledProcessError as e:
-                st.error(f"OpenSCAD failed with exit code {e.returncode}")
-                st.subheader("OpenSCAD stdout")
-                st.code(e.stdout or "<no stdout>")
-                st.subheader("OpenSCAD stderr")
-                st.code(e.stderr or "<no stderr>")
-                return
-        # Add assistant message to history and rerun to display via history loop
-        st.session_state.history.append({
-            "role": "assistant",
-            "content": scad_code,
-            "scad_code": scad_code,
-            "scad_path": scad_path,
-            "stl_path": file_paths["stl"],
-            "3mf_path": file_paths["3mf"]
-        })
-        # Rerun to update chat history display
-        st.rerun()
+        with st.chat_message("user"):
+            st.write(user_input)
+        with st.chat_message("assistant"):
+            # Generate SCAD and 3D files
+            with st.spinner("Generating and rendering your model..."):
+                # Exclude the just-added prompt (stream_scad appends it) so requests grow append-only
+                history_for_api = _history_window(tuple(
+                    (m["role"], m["content"])
+                    for m in st.session_state.history[:-1]
+                    if "content" in m and "role" in m
+                ), 2 * HISTORY_TURNS)
+                # Show the code while it streams in rather than blocking until the full response
+                code_placeholder = st.empty()
+                chunks: list[str] = []
+                for chunk in stream_scad(user_input, history_for_api, api_key):
+                    chunks.append(chunk)
+                    code_placeholder.code("".join(chunks), language="c")
+                scad_code = "".join(chunks).strip()
+                try:
+                    file_paths = generate_3d_files(scad_code, session_work_dir(), formats=("stl",))
+                except subprocess.CalledProcessError as e:
+                    st.error(f"OpenSCAD failed with exit code {e.returncode}")
+                    st.subheader("OpenSCAD stderr")
+                    st.code(e.stderr.decode("utf-8", errors="replace") if e.stderr else "<no stderr>")
+                    return
+            # Add assistant message to history and render it in place of the streamed code,
+            # instead of rerunning the whole script to replay it
+            code_placeholder.empty()
+            st.session_state.history.append({
+                "role": "assistant",
+                "content": scad_code,
+                "scad_code": scad_code,
+                "stl_path": file_paths["stl"],
+            })
+            render_assistant_message(len(st.session_state.history) - 1, st.session_state.history[-1])
 
     # Fixed footer always visible
     st.markdown(